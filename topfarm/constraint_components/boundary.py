@@ -2,10 +2,11 @@ import numpy as np
 from numpy import newaxis as na
 from scipy.spatial import ConvexHull
 from topfarm.constraint_components import Constraint, ConstraintComponent
-from topfarm.utils import smooth_max, smooth_max_gradient
+from topfarm.utils import smooth_max_and_gradient
 import topfarm
 from shapely.geometry import Polygon, MultiPolygon, LineString
 from shapely.ops import unary_union
+from shapely.prepared import prep
 import warnings
 from tqdm import tqdm
 
@@ -65,11 +66,10 @@ class XYBoundaryConstraint(Constraint):
 
     def set_design_var_limits(self, design_vars):
         if self.boundary_type in ['multi_polygon', 'turbine_specific']:
-            bound_min = np.vstack([(bound).min(0) for bound, _ in self.boundary_comp.boundaries]).min(0)
-            bound_max = np.vstack([(bound).max(0) for bound, _ in self.boundary_comp.boundaries]).max(0)
+            boundary_points = np.concatenate([bound for bound, _ in self.boundary_comp.boundaries])
         else:
-            bound_min = self.boundary_comp.xy_boundary.min(0)
-            bound_max = self.boundary_comp.xy_boundary.max(0)
+            boundary_points = self.boundary_comp.xy_boundary
+        bound_min, bound_max = boundary_points.min(0), boundary_points.max(0)
         for k, l, u in zip([topfarm.x_key, topfarm.y_key], bound_min, bound_max):
             if k in design_vars:
                 if len(design_vars[k]) == 4:
@@ -83,7 +83,6 @@ class XYBoundaryConstraint(Constraint):
         self.boundary_comp = self.get_comp(n_wt)
         self.boundary_comp.problem = problem
         self.set_design_var_limits(problem.design_vars)
-        # problem.xy_boundary = np.r_[self.boundary_comp.xy_boundary, self.boundary_comp.xy_boundary[:1]]
         problem.indeps.add_output('xy_boundary', self.boundary_comp.xy_boundary)
         getattr(problem.model, group).add_subsystem('xy_bound_comp', self.boundary_comp, promotes=['*'])
 
@@ -133,6 +132,9 @@ class CircleBoundaryConstraint(XYBoundaryConstraint):
 
 
 class BoundaryBaseComp(ConstraintComponent):
+    # True if boundaryDistances has one value per turbine that only depends on the position of that turbine
+    diagonal_partials = False
+
     def __init__(self, n_wt, xy_boundary=None, const_id=None, units=None, relaxation=False, **kwargs):
         super().__init__(**kwargs)
         self.n_wt = n_wt
@@ -153,23 +155,24 @@ class BoundaryBaseComp(ConstraintComponent):
             self.add_input('time', 0)
         if hasattr(self, 'types'):
             self.add_input('type', np.zeros(self.n_wt))
-        # self.add_output('constraint_violation_' + self.const_id, val=0.0)
         # Explicitly size output array
         # (vector with positive elements if turbines outside of hull)
         self.add_output('boundaryDistances', self.zeros,
                         desc="signed perpendicular distances from each turbine to each face CCW; + is inside")
-        self.declare_partials('boundaryDistances', [topfarm.x_key, topfarm.y_key])
+        if self.diagonal_partials:
+            # Sparse partial declaration
+            rows = cols = np.arange(self.n_wt)
+            self.declare_partials('boundaryDistances', [topfarm.x_key, topfarm.y_key], rows=rows, cols=cols)
+        else:
+            self.declare_partials('boundaryDistances', [topfarm.x_key, topfarm.y_key])
         if self.relaxation:
             self.declare_partials('boundaryDistances', 'time')
 
-        # self.declare_partials('boundaryDistances', ['boundaryVertices', 'boundaryNormals'], method='fd')
-
     def compute(self, inputs, outputs):
         # calculate distances from each point to each face
         args = {x: inputs[x] for x in [topfarm.x_key, topfarm.y_key, topfarm.type_key] if x in inputs}
         boundaryDistances = self.distances(**args)
         outputs['boundaryDistances'] = boundaryDistances
-        # outputs['constraint_violation_' + self.const_id] = np.sum(np.minimum(boundaryDistances, 0) ** 2)
 
     def compute_partials(self, inputs, partials):
         # return Jacobian dict
@@ -177,6 +180,9 @@ class BoundaryBaseComp(ConstraintComponent):
             dx, dy = self.gradients(**{xy: inputs[k] for xy, k in zip('xy', [topfarm.x_key, topfarm.y_key])})
         else:
             dx, dy, dt = self.gradients(**{xy: inputs[k] for xy, k in zip('xy', [topfarm.x_key, topfarm.y_key])})
+        if not self.diagonal_partials and np.ndim(dx) == 1:
+            # dense partials declared for a per turbine gradient, e.g. MultiPolygonBoundaryComp with smooth_min
+            dx, dy = np.diagflat(dx), np.diagflat(dy)
 
         partials['boundaryDistances', topfarm.x_key] = dx
         partials['boundaryDistances', topfarm.y_key] = dy
@@ -211,12 +217,10 @@ class BoundaryBaseComp(ConstraintComponent):
 class ConvexBoundaryComp(BoundaryBaseComp):
     def __init__(self, n_wt, xy_boundary=None, boundary_type='convex_hull', const_id=None, units=None):
         self.boundary_type = boundary_type
-#        self.const_id = const_id
         self.calculate_boundary_and_normals(xy_boundary)
         super().__init__(n_wt, self.xy_boundary, const_id, units)
         self.calculate_gradients()
         self.zeros = np.zeros([self.n_wt, self.nVertices])
-#        self.units = units
 
     def calculate_boundary_and_normals(self, xy_boundary):
         xy_boundary = np.asarray(xy_boundary)
@@ -248,50 +252,17 @@ class ConvexBoundaryComp(BoundaryBaseComp):
         # get the real number of xy_vertices
         self.nVertices = self.xy_boundary.shape[0]
 
-        # initialize normals array
-        unit_normals = np.zeros([self.nVertices, 2])
-
-        # determine if point is inside or outside of each face, and distances from each face
-        for j in range(0, self.nVertices):
-
-            # calculate the unit normal vector of the current face (taking points CCW)
-            if j < self.nVertices - 1:  # all but the set of point that close the shape
-                normal = np.array([self.xy_boundary[j + 1, 1] - self.xy_boundary[j, 1],
-                                   -(self.xy_boundary[j + 1, 0] - self.xy_boundary[j, 0])])
-                unit_normals[j] = normal / np.linalg.norm(normal)
-            else:   # the set of points that close the shape
-                normal = np.array([self.xy_boundary[0, 1] - self.xy_boundary[j, 1],
-                                   -(self.xy_boundary[0, 0] - self.xy_boundary[j, 0])])
-                unit_normals[j] = normal / np.linalg.norm(normal)
-
-        self.unit_normals = unit_normals
+        # calculate the unit normal vector of each face (taking points CCW and closing the shape)
+        edges = np.roll(self.xy_boundary, -1, axis=0) - self.xy_boundary
+        normals = np.stack([edges[:, 1], -edges[:, 0]], axis=1)
+        self.unit_normals = normals / np.linalg.norm(normals, axis=1, keepdims=True)
 
     def calculate_gradients(self):
-        unit_normals = self.unit_normals
-
-        # initialize array to hold distances from each point to each face
-        dfaceDistance_dx = np.zeros([self.n_wt * self.nVertices, self.n_wt])
-        dfaceDistance_dy = np.zeros([self.n_wt * self.nVertices, self.n_wt])
-
-        for i in range(0, self.n_wt):
-            # determine if point is inside or outside of each face, and distances from each face
-            for j in range(0, self.nVertices):
-
-                # define the derivative vectors from the point of interest to the first point of the face
-                dpa_dx = np.array([-1.0, 0.0])
-                dpa_dy = np.array([0.0, -1.0])
-
-                # find perpendicular distances derivatives from point to current surface (vector projection)
-                ddistanceVec_dx = np.vdot(dpa_dx, unit_normals[j]) * unit_normals[j]
-                ddistanceVec_dy = np.vdot(dpa_dy, unit_normals[j]) * unit_normals[j]
-
-                # calculate derivatives for the sign of perpendicular distances from point to current face
-                dfaceDistance_dx[i * self.nVertices + j, i] = np.vdot(ddistanceVec_dx, unit_normals[j])
-                dfaceDistance_dy[i * self.nVertices + j, i] = np.vdot(ddistanceVec_dy, unit_normals[j])
-
-        # return Jacobian dict
-        self.dfaceDistance_dx = dfaceDistance_dx
-        self.dfaceDistance_dy = dfaceDistance_dy
+        # The distance from turbine i to face j only depends on turbine i, and its derivative wrt. x and y is
+        # minus the x and y component of the face unit normal (independent of position). The Jacobian is therefore
+        # block diagonal with one (nVertices, 1) block per turbine
+        self.dfaceDistance_dx = np.kron(np.eye(self.n_wt), -self.unit_normals[:, 0:1])
+        self.dfaceDistance_dy = np.kron(np.eye(self.n_wt), -self.unit_normals[:, 1:2])
 
     def calculate_distance_to_boundary(self, points):
         """
@@ -299,24 +270,16 @@ class ConvexBoundaryComp(BoundaryBaseComp):
         :return face_distace: signed perpendicular distances from each point to each face; + is inside
         """
 
-        nPoints = np.array(points).shape[0]
-        xy_boundary = self.xy_boundary[:-1]
-        nVertices = xy_boundary.shape[0]
-        vertices = xy_boundary
+        vertices = self.xy_boundary[:-1]
         unit_normals = self.unit_normals
-        # initialize array to hold distances from each point to each face
-        face_distance = np.zeros([nPoints, nVertices])
-        from numpy import newaxis as na
 
         # define the vector from the point of interest to the first point of the face
         PA = (vertices[:, na] - points[na])
 
-        # find perpendicular distances from point to current surface (vector projection)
-        dist = np.sum(PA * unit_normals[:, na], 2)
-        # calculate the sign of perpendicular distances from point to current face (+ is inside, - is outside)
-        d_vec = dist[:, :, na] * unit_normals[:, na]
-        face_distance = np.sum(d_vec * unit_normals[:, na], 2)
-        return face_distance.T
+        # signed perpendicular distances from point to each face (+ is inside, - is outside).
+        # As the normals are unit vectors, this is just the projection of PA on the normal
+        dist = np.einsum('vpd,vd->vp', PA, unit_normals)
+        return dist.T
 
     def distances(self, x, y):
         return self.calculate_distance_to_boundary(np.array([x, y]).T)
@@ -324,30 +287,60 @@ class ConvexBoundaryComp(BoundaryBaseComp):
     def gradients(self, x, y):
         return self.dfaceDistance_dx, self.dfaceDistance_dy
 
+    def _move_inside(self, dist, margin):
+        """Smallest movements (#P, 2) of points with face distances, dist (#P, #Faces), such that all distances
+        become at least margin (#P,). The closest point of the polygon with all faces shifted inwards by margin is
+        found on the face segments between the corners of the shifted polygon, i.e. in O(#Faces) per point.
+        Also returns a (#P,) mask of points where a shifted face vanished, such that the segments do not form
+        the shifted polygon"""
+        g = -self.unit_normals  # gradient of the face distances wrt. x and y, independent of position
+        g_next, b = np.roll(g, -1, 0), margin[:, na] - dist
+        b_next = np.roll(b, -1, 1)
+        # corner j of the shifted polygon is the intersection of shifted face j, g.move = b, and face j+1
+        det = g[:, 0] * g_next[:, 1] - g[:, 1] * g_next[:, 0]
+        corner = np.stack([b * g_next[:, 1] - b_next * g[:, 1], b_next * g[:, 0] - b * g_next[:, 0]], -1) / det[:, na]
+        # the segment of face j goes from corner j-1 to corner j. It is reversed if the shifted face vanished
+        start = np.roll(corner, 1, 1)
+        segment = corner - start
+        vanished = np.any(np.einsum('pfd,fd->pf', segment, np.diff(self.xy_boundary, axis=0)) < 0, 1)
+        # closest point to the current position, i.e. move = 0, on each segment and the closest of these
+        segment_len2 = np.maximum(np.einsum('pfd,pfd->pf', segment, segment), np.finfo(float).tiny)
+        t = np.clip(-np.einsum('pfd,pfd->pf', start, segment) / segment_len2, 0, 1)
+        closest = start + t[..., na] * segment
+        closest_face = np.argmin(np.einsum('pfd,pfd->pf', closest, closest), 1)
+        return np.take_along_axis(closest, closest_face[:, na, na], 1)[:, 0], vanished
+
     def satisfy(self, state, pad=1.1):
         x, y = [np.asarray(state[xyz], dtype=float) for xyz in [topfarm.x_key, topfarm.y_key]]
         dist = self.distances(x, y)
-        dist = np.where(dist < 0, np.minimum(dist, -.01), dist)
-        dx, dy = self.gradients(x, y)  # independent of position
-        dx = dx[:self.nVertices, 0]
-        dy = dy[:self.nVertices, 0]
-        for i in np.where(dist.min(1) < 0)[0]:  # loop over turbines that violate edges
-            # find smallest movement that where the constraints are satisfied
-            d = dist[i]
-            v = np.linspace(-np.abs(d.min()), np.abs(d.min()), 100)
-            X, Y = np.meshgrid(v, v)
-            m = np.ones_like(X)
-            for dx_, dy_, d in zip(dx, dy, dist.T):
-                m = np.logical_and(m, X * dx_ + Y * dy_ >= -d[i])
-            index = np.argmin(X[m]**2 + Y[m]**2)
-            x[i] += X[m][index]
-            y[i] += Y[m][index]
+        i = np.where(dist.min(1) < 0)[0]  # turbines that violate edges
+        if len(i):
+            # The turbines are moved to just inside the boundary. The distance from the vertex centroid to the
+            # nearest face is a lower bound of the inradius. Capping the margin at a small fraction of it keeps
+            # the shifted polygon non-empty
+            centroid = self.xy_boundary[:-1].mean(0)
+            max_margin = .01 * self.distances(*centroid[:, na]).min()
+            margin = np.minimum((pad - 1) * np.maximum(-dist[i].min(1), .01), max_margin)
+            move, vanished = self._move_inside(dist[i], margin)
+            for _ in range(50):
+                if not vanished.any():
+                    break
+                # a short face may vanish when shifted. Halve the margin, as all faces are present for margin 0
+                j = np.where(vanished)[0]
+                margin[j] /= 2
+                move[j], vanished[j] = self._move_inside(dist[i[j]], margin[j])
+            x[i] += move[:, 0]
+            y[i] += move[:, 1]
         state[topfarm.x_key] = x
         state[topfarm.y_key] = y
         return state
 
 
 class PolygonBoundaryComp(BoundaryBaseComp):
+    diagonal_partials = True
+    # number of edges evaluated at a time when only the distance to the nearest edge is needed
+    edge_block_size = 256
+
     def __init__(self, n_wt, xy_boundary, const_id=None, units=None, relaxation=False):
 
         self.nTurbines = n_wt
@@ -355,6 +348,7 @@ class PolygonBoundaryComp(BoundaryBaseComp):
         self.zeros = np.zeros(self.nTurbines)
         self.units = units
         self.boundary_properties = self.get_boundary_properties(xy_boundary)
+        self.edge_properties_3d = self.broadcast_boundary_properties(self.boundary_properties[1:])
         BoundaryBaseComp.__init__(self, n_wt, xy_boundary=self.boundary_properties[0], const_id=const_id,
                                   units=units, relaxation=relaxation)
         self._cache_input = None
@@ -388,58 +382,58 @@ class PolygonBoundaryComp(BoundaryBaseComp):
         A_normal = (edge_unit_normal + np.roll(edge_unit_normal, 1, 1)) / 2
         B_normal = np.roll(A_normal, -1, 1)
 
-        # import matplotlib.pyplot as plt
-        # for (x, y), (dx, dy), (unx, uny) in zip(A.T, AB.T, edge_unit_normal.T):
-        #     plt.arrow(x, y, dx, dy, color='k', head_width=.2)
-        #     plt.arrow(x, y, unx, uny, color='r', head_width=.2)
-        # for (x, y), (nx, ny) in zip(A.T, A_normal.T):
-        #     plt.arrow(x, y, nx, ny, color='b', head_width=.2)
-        # for (x, y), (nx, ny) in zip(B.T, B_normal.T):
-        #     plt.arrow(x, y, nx / 2, ny / 2, color='g', head_width=.2)
-
         return (xy_boundary, A, B, AB, AB_len, edge_unit_normal, A_normal, B_normal)
 
+    def broadcast_boundary_properties(self, boundary_properties):
+        """Add the point dimension to the edge properties used by _calc_distance_and_gradients, i.e. (2, 1, #Edges)
+        and (1, #Edges) for AB.AB, which replaces AB_len. Done once at setup instead of in every evaluation.
+        All properties are packed in one contiguous (13, #Edges) block and returned as views into it, such that
+        each x or y component is a contiguous row"""
+        A, B, AB, AB_len, edge_unit_normal, A_normal, B_normal = boundary_properties
+        # AB.AB is evaluated as AP.AB in the kernel, such that AP.AB == AB.AB exactly for P == B
+        AB_dot_AB = AB[0] * AB[0] + AB[1] * AB[1]
+        block = np.vstack([A, B, AB, edge_unit_normal, A_normal, B_normal, AB_dot_AB])
+        A, B, AB, edge_unit_normal, A_normal, B_normal = [block[i:i + 2, na] for i in range(0, 12, 2)]
+        return [A, B, AB, edge_unit_normal, A_normal, B_normal, block[12:13]]
+
     def _calc_distance_and_gradients(self, x, y, boundary_properties=None):
         """
         distances point, P=(x,y) to edge(A->B)
         +/-: inside/outside
         """
-        def vec_len(vec):
-            return np.linalg.norm(vec, axis=0)
-
-        boundary_properties = boundary_properties or self.boundary_properties[1:]
-        A, B, AB, AB_len, edge_unit_normal, A_normal, B_normal = boundary_properties
+        boundary_properties = boundary_properties or self.edge_properties_3d
+        A, B, AB, edge_unit_normal, A_normal, B_normal, AB_dot_AB = boundary_properties
         """
         A: edge start point
         B: edge end point
         edge_unit_normal: unit vector perpendicular to edge pointing to the good side
         (i.e. inside for inclusion zones and outside for exclusion zones)
         AB: Vector from A to B (edge)
-        AB_len: length of AB (edge)
+        AB_dot_AB: AB.AB, i.e. |AB|^2
         A_normal: mean of edge unit normal vectors adjacent to A
         B_normal: mean of edge unit normal vectors adjacent to B
+        The properties are already broadcastable to (2, #P, #Edges), see broadcast_boundary_properties
         """
-
-        # Add dim to match (2, #P, #Edges), where the first dimension is (x,y)
-        P = np.array([x, y])[:, :, na]
-        A, B, AB = A[:, na], B[:, na], AB[:, na]
-        edge_unit_normal, A_normal, B_normal = edge_unit_normal[:, na], A_normal[:, na], B_normal[:, na]
-        AB_len = AB_len[na]
+        # The x and y components are handled as separate (#P, #Edges) arrays (views of the (1, #Edges) rows of the
+        # edge properties) instead of stacked (2, #P, #Edges) arrays that must be reduced along the first axis
+        (Ax, Ay), (Bx, By), (ABx, ABy) = A, B, AB
+        (nx, ny), (Anx, Any), (Bnx, Bny) = edge_unit_normal, A_normal, B_normal
+        x, y = np.asarray(x)[:, na], np.asarray(y)[:, na]
 
         # ===============================================================================================================
         # Determine if P is closer to A, B or the edge (between A and B)
         # ===============================================================================================================
-        AP = P - A  # vector from edge start to point
-        BP = P - B  # vector from edge end to point
+        APx, APy = x - Ax, y - Ay  # vector from edge start to point
 
-        # signed component of AP on the edge vector
-        a_tilde = np.sum(AP * AB, axis=0) / AB_len
+        # signed component of AP on the edge vector times |AB|. Comparing AP.AB with 0 and AB.AB instead of
+        # AP.AB/|AB| with 0 and |AB| avoids rounding errors that can put points on B on the wrong side of B
+        AP_dot_AB = APx * ABx + APy * ABy
 
-        # a_tilde < 0: closer to A
-        # a_tilde > |AB|: closer to B
+        # AP.AB < 0: closer to A
+        # AP.AB > |AB|^2: closer to B
         # else: closer to edge (between A and B)
-        use_A = 0 > a_tilde
-        use_B = a_tilde > AB_len
+        use_A = 0 > AP_dot_AB
+        use_B = AP_dot_AB > AB_dot_AB
 
         # ===============================================================================================================
         # Calculate distance from P to closer point on edge
@@ -447,55 +441,91 @@ class PolygonBoundaryComp(BoundaryBaseComp):
 
         # Perpendicular distances to edge (AP dot edge_unit_normal product).
         # This is the distance to the edge if not use_A or use_B
-        distance = np.sum((AP) * edge_unit_normal, 0)
-
-        # Update distance for points closer to A
-        good_side_of_A = (np.sum((AP * A_normal)[:, use_A], 0) > 0)
-        sign_use_A = np.where(good_side_of_A, 1, -1)
-        distance[use_A] = (vec_len(AP[:, use_A]) * sign_use_A)
-
-        # Update distance for points closer to B
-        good_side_of_B = np.sum((BP * B_normal)[:, use_B], 0) > 0
-        sign_use_B = np.where(good_side_of_B, 1, -1)
-        distance[use_B] = (vec_len(BP[:, use_B]) * sign_use_B)
+        perpendicular_distance = APx * nx + APy * ny
+
+        # Distance to the closer end point for points closer to A or B, i.e. the length of AP or BP
+        # signed by the side of the node normal. Both cases are evaluated for all points and selected with
+        # np.where instead of updating masked subsets
+        use_end = use_A | use_B
+        end_x = np.where(use_B, x - Bx, APx)
+        end_y = np.where(use_B, y - By, APy)
+        good_side_of_end = end_x * np.where(use_B, Bnx, Anx) + end_y * np.where(use_B, Bny, Any) > 0
+        sign_end = np.where(good_side_of_end, 1, -1)
+        end_len = np.sqrt(end_x**2 + end_y**2)
+        distance = np.where(use_end, end_len * sign_end, perpendicular_distance)
 
         # ===============================================================================================================
         # Calculate gradient of distance from P to closer point on edge wrt. x and y
         # ===============================================================================================================
 
-        # Gradient of perpendicular distances to edge.
-        # This is the gradient if not use_A or use_B
-        ddist_dxy = np.tile(edge_unit_normal, (1, len(x), 1))
-
-        # Update gradient for points closer to A or B
-        ddist_dxy[:, use_A] = sign_use_A * (AP[:, use_A] / vec_len(AP[:, use_A]))
-        ddist_dxy[:, use_B] = sign_use_B * (BP[:, use_B] / vec_len(BP[:, use_B]))
-        ddist_dX, ddist_dY = ddist_dxy
+        # Gradient of perpendicular distances to edge is the edge unit normal (broadcasted to all points).
+        # For points closer to A or B it is the signed unit vector from the end point to P.
+        # The reciprocal is limited to use_end as AP/BP may be zero elsewhere
+        inv_end_len = np.reciprocal(end_len, out=np.zeros_like(end_len), where=use_end)
+        scale = inv_end_len * sign_end
+        ddist_dX = np.where(use_end, end_x * scale, nx)
+        ddist_dY = np.where(use_end, end_y * scale, ny)
 
         return distance, ddist_dX, ddist_dY
 
+    def _in_cache(self, *inputs):
+        """Check if inputs are equal to the inputs of the cached output.
+        Shapes and end points are compared before the full arrays"""
+        if self._cache_input is None or len(inputs) != len(self._cache_input):
+            return False
+        inputs = [np.asarray(v) for v in inputs]
+        for v, c in zip(inputs, self._cache_input):
+            if v.shape != c.shape or (v.size and (v.flat[0] != c.flat[0] or v.flat[-1] != c.flat[-1])):
+                return False
+        return all(np.array_equal(v, c) for v, c in zip(inputs, self._cache_input))
+
+    def _update_cache(self, inputs, output):
+        # copy inputs as OpenMDAO updates the input arrays in place
+        self._cache_input = [np.array(v) for v in inputs]
+        self._cache_output = output
+
+    def _calc_nearest_distance_and_gradients(self, x, y, boundary_properties=None):
+        """Distance and gradients wrt. x and y of the nearest edge, i.e. the edge with the smallest absolute distance.
+        The edges are evaluated in blocks of edge_block_size while keeping the nearest values found so far, such that
+        the (#P, #Edges) arrays are never allocated for all edges at once"""
+        boundary_properties = boundary_properties or self.edge_properties_3d
+        n_edges = boundary_properties[0].shape[-1]
+        nearest = None
+        for j0 in range(0, n_edges, self.edge_block_size):
+            edge_block = [v[..., j0:j0 + self.edge_block_size] for v in boundary_properties]
+            distance, ddist_dX, ddist_dY = self._calc_distance_and_gradients(x, y, edge_block)
+            # gather the values of the closest edge (np.choose is limited to 32 edges)
+            closest_edge_index = np.argmin(np.abs(distance), 1)[:, na]
+            nearest = self._nearest_of(nearest, [np.take_along_axis(v, closest_edge_index, 1)[:, 0]
+                                                 for v in [distance, ddist_dX, ddist_dY]])
+        return nearest
+
+    def _nearest_of(self, nearest, candidate):
+        """Merge two lists of (distance, ddist_dX, ddist_dY), selecting the candidate values where the candidate
+        distance is strictly closer, such that ties resolve to the first edge as in np.argmin"""
+        if nearest is None:
+            return candidate
+        closer = np.abs(candidate[0]) < np.abs(nearest[0])
+        return [np.where(closer, c, n) for c, n in zip(candidate, nearest)]
+
     def calc_distance_and_gradients(self, x, y):
-        if not np.shape([x, y]) == np.shape(self._cache_input):
-            pass
-        elif np.all(np.array([x, y]) == self._cache_input):
+        if self._in_cache(x, y):
             return self._cache_output
-        distance, ddist_dX, ddist_dY = self._calc_distance_and_gradients(x, y)
-        closest_edge_index = np.argmin(np.abs(distance), 1)
-        self._cache_input = np.array([x, y])
-        self._cache_output = [np.choose(closest_edge_index, v.T) for v in [distance, ddist_dX, ddist_dY]]
+        self._update_cache((x, y), self._calc_nearest_distance_and_gradients(x, y))
         return self._cache_output
 
     def distances(self, x, y):
         return self.calc_distance_and_gradients(x, y)[0]
 
     def gradients(self, x, y):
+        """Diagonal of the Jacobian of distances wrt. x and y"""
         _, dx, dy = self.calc_distance_and_gradients(x, y)
-        return np.diagflat(dx), np.diagflat(dy)
+        return dx, dy
 
     def satisfy(self, state, pad=1.1):
         x, y = [np.asarray(state[xy], dtype=float) for xy in [topfarm.x_key, topfarm.y_key]]
         dist = self.distances(x, y)
-        dx, dy = map(np.diag, self.gradients(x, y))
+        dx, dy = self.gradients(x, y)
         m = dist < 0
         x[m] -= dx[m] * dist[m] * pad
         y[m] -= dy[m] * dist[m] * pad
@@ -512,6 +542,8 @@ class CircleBoundaryComp(PolygonBoundaryComp):
         xy_boundary = self.center + np.array([np.cos(t), np.sin(t)]).T * self.radius
         BoundaryBaseComp.__init__(self, n_wt, xy_boundary, const_id, units)
         self.zeros = np.zeros(self.n_wt)
+        self._cache_input = None
+        self._cache_output = None
 
     def plot(self, ax=None):
         from matplotlib.pyplot import Circle
@@ -520,17 +552,21 @@ class CircleBoundaryComp(PolygonBoundaryComp):
         circle = Circle(self.center, self.radius, color='k', fill=False)
         ax.add_artist(circle)
 
-    def distances(self, x, y):
-        return self.radius - np.sqrt((x - self.center[0])**2 + (y - self.center[1])**2)
-
-    def gradients(self, x, y):
-        theta = np.arctan2(y - self.center[1], x - self.center[0])
-        dx = -1 * np.ones_like(x)
-        dy = -1 * np.ones_like(x)
-        dist = self.radius - np.sqrt((x - self.center[0])**2 + (y - self.center[1])**2)
-        not_center = dist != self.radius
-        dx[not_center], dy[not_center] = -np.cos(theta[not_center]), -np.sin(theta[not_center])
-        return np.diagflat(dx), np.diagflat(dy)
+    def calc_distance_and_gradients(self, x, y):
+        """
+        distances = radius - |P-center|
+        ddist_dx, ddist_dy = -(P-center) / |P-center| (-1 in the center)
+        """
+        if self._in_cache(x, y):
+            return self._cache_output
+        dx, dy = x - self.center[0], y - self.center[1]
+        r = np.sqrt(dx**2 + dy**2)
+        not_center = r > 0
+        inv_r = np.divide(1, r, out=np.zeros_like(r), where=not_center)
+        ddist_dx = np.where(not_center, -dx * inv_r, -1)
+        ddist_dy = np.where(not_center, -dy * inv_r, -1)
+        self._update_cache((x, y), [self.radius - r, ddist_dx, ddist_dy])
+        return self._cache_output
 
 
 class Zone(object):
@@ -579,14 +615,22 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
         self.zones = zones
         self.bounds_poly, xy_boundaries = self.get_xy_boundaries()
         PolygonBoundaryComp.__init__(self, n_wt, xy_boundary=xy_boundaries[0], const_id=const_id, units=units, relaxation=relaxation)
-        # self.bounds_poly = [Polygon(x) for x in xy_boundaries]
         self.incl_excls = [x.incl for x in zones]
         self._setup_boundaries(self.bounds_poly, self.incl_excls)
         self.relaxation = relaxation
         self.method = method
+        # |D_ij| and nearest edge index, and smooth minimum, of the distances in the cache
+        self._cache_nearest = self._cache_smooth_min = None
         if simplify_geometry:
             self.simplify(simplify_geometry)
 
+    @property
+    def diagonal_partials(self):
+        # With smooth_min, alpha = -max(|D_ij|) is taken over all turbines, so a distance also depends on the
+        # positions of the other turbines and dense partials are declared. The dependency through alpha is not
+        # included in the gradients
+        return self.method == 'nearest'
+
     def simplify(self, simplify_geometry):
         bounds = [bi[0] for bi in self.boundaries]
         self.incl_excls = [bi[1] for bi in self.boundaries]
@@ -597,9 +641,6 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
             self.bounds_poly = [rp.simplify(simplify_geometry) for rp in polygons]
         self._setup_boundaries(self.bounds_poly, self.incl_excls)
 
-    # def line_to_xy_boundary(self, line, buffer):
-    #     return np.asarray(Polygon(LineString(line).buffer(buffer, join_style=2).exterior).exterior.coords)
-
     def get_xy_boundaries(self):
         polygons = []
         bounds = []
@@ -623,8 +664,8 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
         boundary_properties_list_all = list(zip(*[self.get_boundary_properties(bound, incl_excl)[1:]
                                                   for bound, incl_excl in self.boundaries]))
 
-        self.boundary_properties_list_all = [np.concatenate(v, -1)
-                                             for v in boundary_properties_list_all]
+        self.boundary_properties_list_all = self.broadcast_boundary_properties(
+            [np.concatenate(v, -1) for v in boundary_properties_list_all])
 
     def _poly_to_bound(self, polygons):
         boundaries = []
@@ -649,6 +690,8 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
         domain = []
         for i in tqdm(range(len(boundary_polygons))):
             b = boundary_polygons[i]
+            # b is tested against all polygons in domain, so it is prepared for fast repeated predicates
+            prepared_b = prep(b)
             if len(domain) == 0:
                 if incl_excls[i]:
                     domain.append(b)
@@ -659,14 +702,16 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
                 if incl_excls[i]:
                     temp = []
                     for j, d in enumerate(domain):
-                        if d.intersects(b):
+                        if prepared_b.intersects(d):
                             b = unary_union([d, b])
+                            prepared_b = prep(b)
                         else:
                             if d.contains(b):
                                 warnings.warn("Boundary is fully contained preceding polygon and will be ignored")
                                 pass
-                            elif b.contains(d):
+                            elif prepared_b.contains(d):
                                 b = d
+                                prepared_b = prep(b)
                                 warnings.warn("Boundary is fully containing preceding polygon and will override it")
                                 pass
                             else:
@@ -679,7 +724,7 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
                 else:
                     temp = []
                     for j, d in enumerate(domain):
-                        if d.intersects(b):
+                        if prepared_b.intersects(d):
                             nonoverlap = (d.symmetric_difference(b)).difference(b)
                             if isinstance(nonoverlap, type(Polygon())):
                                 temp.append(nonoverlap)
@@ -688,7 +733,7 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
                                     if x.area > 1e-3:
                                         temp.append(x)
                         else:
-                            if b.contains(d):
+                            if prepared_b.contains(d):
                                 warnings.warn("Exclusion boundary fully consumes preceding polygon")
                                 pass
                             else:
@@ -699,8 +744,10 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
                     domain = temp
         return domain
 
-    def sign(self, Dist_ij):
-        return np.sign(Dist_ij[np.arange(Dist_ij.shape[0]), np.argmin(abs(Dist_ij), axis=1)])
+    def sign(self, Dist_ij, nearest_j=None):
+        if nearest_j is None:
+            nearest_j = np.argmin(np.abs(Dist_ij), axis=1)
+        return np.sign(np.take_along_axis(Dist_ij, nearest_j[:, na], 1)[:, 0])
 
     def calc_distance_and_gradients(self, x, y):
         '''
@@ -721,19 +768,41 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
             Jacobian of the distance matrix D_ij with respect to x and y.
 
         '''
-        if not np.shape([x, y]) == np.shape(self._cache_input):
-            pass
-        elif np.all(np.array([x, y]) == self._cache_input) & (not self.relaxation):
+        # the cache is not used with relaxation as the relaxation is added to the output in place
+        if not self.relaxation and self._in_cache(x, y):
             return self._cache_output
 
         Dist_ij, ddist_dX, ddist_dY = self._calc_distance_and_gradients(x, y, self.boundary_properties_list_all)
 
-        dDdk_ijk = np.moveaxis([ddist_dX, ddist_dY], 0, -1)
-        sign_i = self.sign(Dist_ij)
-        self._cache_input = np.array([x, y])
-        self._cache_output = [Dist_ij, dDdk_ijk, sign_i]
+        # stacked directly into a contiguous (#P, #Edges, 2) array
+        dDdk_ijk = np.stack([ddist_dX, ddist_dY], axis=-1)
+        # |D_ij| and the index of the nearest edge are shared by sign, distances and gradients
+        absDist_ij = np.abs(Dist_ij)
+        nearest_j = np.argmin(absDist_ij, axis=1)
+        sign_i = self.sign(Dist_ij, nearest_j)
+        self._update_cache((x, y), [Dist_ij, dDdk_ijk, sign_i])
+        self._cache_nearest = absDist_ij, nearest_j
+        self._cache_smooth_min = None
+        return self._cache_output
+
+    def calc_nearest_distance_and_gradients(self, x, y):
+        """Distance, gradients wrt. x and y and sign of the nearest edge. Unlike calc_distance_and_gradients, the
+        (#P, #Edges) distance and gradient arrays are not stored. Used for method='nearest' without relaxation"""
+        # 'nearest' is added to the cache key to distinguish the output from calc_distance_and_gradients
+        if self._in_cache(x, y, 'nearest'):
+            return self._cache_output
+        Dist_i, dDdx_i, dDdy_i = self._calc_nearest_distance_and_gradients(x, y, self.boundary_properties_list_all)
+        self._update_cache((x, y, 'nearest'), [Dist_i, dDdx_i, dDdy_i, np.sign(Dist_i)])
         return self._cache_output
 
+    def _smooth_min(self):
+        """Smooth minimum of the cached |D_ij| and its derivative wrt. |D_ij|. Computed once per evaluation of
+        calc_distance_and_gradients and shared by distances and gradients"""
+        if self._cache_smooth_min is None:
+            absDist_ij = self._cache_nearest[0]
+            self._cache_smooth_min = smooth_max_and_gradient(absDist_ij, -absDist_ij.max(), axis=1)
+        return self._cache_smooth_min
+
     def calc_relaxation(self, iteration_no=None):
         '''
         The tupple relaxation contains a first term for the penalty constant
@@ -744,11 +813,14 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
         return max(0, self.relaxation[0] * (self.relaxation[1] - iteration_no))
 
     def distances(self, x, y):
+        if self.method == 'nearest' and not self.relaxation:
+            return self.calc_nearest_distance_and_gradients(x, y)[0]
         Dist_ij, _, sign_i = self.calc_distance_and_gradients(x, y)
+        nearest_j = self._cache_nearest[1]
         if self.method == 'smooth_min':
-            Dist_i = smooth_max(np.abs(Dist_ij), -np.abs(Dist_ij).max(), axis=1) * sign_i
+            Dist_i = self._smooth_min()[0] * sign_i
         elif self.method == 'nearest':
-            Dist_i = Dist_ij[np.arange(x.size), np.argmin(np.abs(Dist_ij), axis=1)]
+            Dist_i = np.take_along_axis(Dist_ij, nearest_j[:, na], 1)[:, 0]
         else:
             warning = f'method: {self.method} is not implemented. Available options are smooth_min and nearest.'
             warnings.warn(warning)
@@ -758,25 +830,34 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
 
     def gradients(self, x, y):
         '''
+        Diagonal of the Jacobian of distances wrt. x and y.
         The derivate of the smooth maximum with respect to x and y is calculated with the chain rule:
             dS/dk = dS/dD * dD/dk
             where S is smooth maximum, D is distance to edge and k is the spacial dimension
         '''
+        if self.method == 'nearest' and not self.relaxation:
+            return self.calc_nearest_distance_and_gradients(x, y)[1:3]
         Dist_ij, dDdk_ijk, _ = self.calc_distance_and_gradients(x, y)
+        absDist_ij, nearest_j = self._cache_nearest
         if self.relaxation:
             Dist_ij += self.calc_relaxation()
-            # dDdt = -self.relaxation[1]
+            absDist_ij = np.abs(Dist_ij)
+            nearest_j = np.argmin(absDist_ij, axis=1)
         if self.method == 'smooth_min':
-            dSdDist_ij = smooth_max_gradient(np.abs(Dist_ij), -np.abs(Dist_ij).max(), axis=1)
+            if self.relaxation:
+                # the relaxed distances are not cached
+                dSdDist_ij = smooth_max_and_gradient(absDist_ij, -absDist_ij.max(), axis=1)[1]
+            else:
+                dSdDist_ij = self._smooth_min()[1]
             dSdkx_i, dSdky_i = (dSdDist_ij[:, :, na] * dDdk_ijk).sum(axis=1).T
         elif self.method == 'nearest':
-            dSdkx_i, dSdky_i = dDdk_ijk[np.arange(x.size), np.argmin(np.abs(Dist_ij), axis=1), :].T
+            dSdkx_i, dSdky_i = np.take_along_axis(dDdk_ijk, nearest_j[:, na, na], 1)[:, 0].T
 
         if self.relaxation:
             # as relaxed distance is relaxation + distance, the gradient with respect to x and y is unchanged
-            gradients = np.diagflat(dSdkx_i), np.diagflat(dSdky_i), np.ones(self.n_wt) * self.relaxation[1]
+            gradients = dSdkx_i, dSdky_i, np.ones(self.n_wt) * self.relaxation[1]
         else:
-            gradients = np.diagflat(dSdkx_i), np.diagflat(dSdky_i)
+            gradients = dSdkx_i, dSdky_i
         return gradients
 
     def relaxed_polygons(self, iteration_no=None):
@@ -795,24 +876,23 @@ class MultiPolygonBoundaryComp(PolygonBoundaryComp):
 
 
 class TurbineSpecificBoundaryComp(MultiPolygonBoundaryComp):
+    # the nearest edge is used for all methods
+    diagonal_partials = True
+
     def __init__(self, n_wt, wind_turbines, zones, const_id=None,
                  units=None, relaxation=False, method='nearest', simplify_geometry=False):
-        # self.dependencies = [d or {'type': None, 'multiplier': None, 'ref': None} for d in dependencies]
-        # self.multi_boundary = xy_boundaries = self.get_xy_boundaries(boundaries, geometry_types, incl_excls)
         self.wind_turbines = wind_turbines
         self.types = wind_turbines.types()
-        # self.incl_excls = incl_excls
         self.n_wt = n_wt
         self.zones = zones
         self.ts_polygon_boundaries, ts_xy_boundaries = self.get_ts_boundaries()
         MultiPolygonBoundaryComp.__init__(self, n_wt=n_wt, zones=zones, const_id=const_id, units=units,
                                           relaxation=relaxation, method=method, simplify_geometry=simplify_geometry)
-        # self.polygon_boundaries = [Polygon(x) for x, _ in xy_boundaries]
-        # self.ts_polygon_boundaries = self.get_ts_polygon_boundaries(self.types)
         self.ts_merged_polygon_boundaries = self.merge_boundaries()
         self.ts_merged_xy_boundaries = self.get_ts_xy_boundaries()
         self.ts_boundary_properties = self.get_ts_boundary_properties()
-        self.ts_item_indices = self.get_ts_item_indices()
+        self.ts_edge_properties_3d = [[self.broadcast_boundary_properties(bp[1:]) for bp in bps]
+                                      for bps in self.ts_boundary_properties]
 
     def get_ts_boundaries(self):
         polygons = []
@@ -837,68 +917,22 @@ class TurbineSpecificBoundaryComp(MultiPolygonBoundaryComp):
             polygons.append(temp1)
             bounds.append(temp2)
         return polygons, bounds
-        # for wt
-        # temp = []
-        # for n, (b, t, ie) in enumerate(zip(boundaries, geometry_types, incl_excls)):
-        #     if t == 'line':
-        #         bound = np.asarray(Polygon(LineString(b).buffer(default_ref, join_style=2).exterior).exterior.coords)
-        #         self.dependencies[n]['ref'] = default_ref
-        #     elif t == 'polygon':
-        #         bound = b
-        #     else:
-        #         raise NotImplementedError("Geometry type '%s' is not implemented" % b)
-        #     temp.append((bound, ie))
-
-    # def get_ts_polygon_boundaries(self, types):
-    #     temp = []
-    #     for t in set(types):
-    #         d = self.wind_turbines.diameter(t)
-    #         h = self.wind_turbines.hub_height(t)
-    #         temp.append(self.get_ts_polygon_boundary(d, h))
-    #     return temp
 
     def get_ts_xy_boundaries(self):
         return [self._poly_to_bound(b) for b in self.ts_merged_polygon_boundaries]
 
-    # def get_ts_polygon_boundary(self, d=None, h=None):
-    #     temp = []
-    #     for bound, dep in zip(self.polygon_boundaries, self.dependencies):
-    #         ref = dep['ref'] or 0
-    #         if dep['type'] == 'D':
-    #             ts_polygon_boundary = bound.buffer(dep['multiplier']*d-ref, join_style=2)
-    #         elif dep['type'] == 'H':
-    #             ts_polygon_boundary = bound.buffer(dep['multiplier']*h-ref, join_style=2)
-    #         else:
-    #             ts_polygon_boundary = bound
-    #         temp.append(ts_polygon_boundary)
-    #     return temp
-
     def merge_boundaries(self):
         return [self._calc_resulting_polygons(bounds, self.incl_excls) for bounds in self.ts_polygon_boundaries]
 
     def get_ts_boundary_properties(self,):
         return [[self.get_boundary_properties(bound) for bound, _ in bounds] for bounds in self.ts_merged_xy_boundaries]
 
-    def get_ts_item_indices(self):
-        temp = []
-        for bounds in self.ts_merged_xy_boundaries:
-            n_edges = np.asarray([len(bound) for bound, _ in bounds])
-            n_edges_tot = np.sum(n_edges)
-            start_at = np.cumsum(n_edges) - n_edges
-            end_at = start_at + n_edges
-            item_indices = [n_edges_tot, start_at, end_at]
-            temp.append(item_indices)
-        return temp
-
     def calc_distance_and_gradients(self, x, y, types=None):
-        if self._cache_input is None:
-            pass
-        elif not np.shape([x, y]) == np.shape(self._cache_input[0]) or not np.shape(types) == np.shape(self._cache_input[1]):
-            pass
-        elif np.all(np.array([x, y]) == self._cache_input[0]) & (not self.relaxation) & np.all(np.asarray([types]) == self._cache_input[1]):
-            return self._cache_output
         if types is None:
             types = np.zeros(self.n_wt)
+        # the cache is not used with relaxation as the relaxation is added to the output in place
+        if not self.relaxation and self._in_cache(x, y, types):
+            return self._cache_output
         Dist_i = np.zeros(self.n_wt)
         sign_i = np.zeros(self.n_wt)
         dDdx_i = np.zeros(self.n_wt)
@@ -906,26 +940,16 @@ class TurbineSpecificBoundaryComp(MultiPolygonBoundaryComp):
         for t in set(types):
             t = int(t)
             idx = (types == t)
-            n_edges_tot, start_at, end_at = self.ts_item_indices[t]
-            Dist_ij = np.zeros((sum(idx), n_edges_tot))
-            dDdk_ijk = np.zeros((sum(idx), n_edges_tot, 2))
+            # keep the values of the nearest edge of each boundary instead of the distances to all edges
+            nearest = None
             for n, (bound, bound_type) in enumerate(self.ts_merged_xy_boundaries[t]):
-                sa = start_at[n]
-                ea = end_at[n]
-                distance, ddist_dX, ddist_dY = self._calc_distance_and_gradients(x[idx], y[idx], self.ts_boundary_properties[t][n][1:])
+                boundary_nearest = self._calc_nearest_distance_and_gradients(x[idx], y[idx], self.ts_edge_properties_3d[t][n])
                 if bound_type == 0:
-                    distance *= -1
-                    ddist_dX *= -1
-                    ddist_dY *= -1
-                Dist_ij[:, sa:ea] = distance
-                dDdk_ijk[:, sa:ea, 0] = ddist_dX
-                dDdk_ijk[:, sa:ea, 1] = ddist_dY
-
-            sign_i[idx] = self.sign(Dist_ij)
-            Dist_i[idx] = Dist_ij[np.arange(sum(idx)), np.argmin(np.abs(Dist_ij), axis=1)]
-            dDdx_i[idx], dDdy_i[idx] = dDdk_ijk[np.arange(sum(idx)), np.argmin(np.abs(Dist_ij), axis=1), :].T
-        self._cache_input = (np.array([x, y]), np.asarray(types))
-        self._cache_output = [Dist_i, dDdx_i, dDdy_i, sign_i]
+                    boundary_nearest = [-v for v in boundary_nearest]
+                nearest = self._nearest_of(nearest, boundary_nearest)
+            Dist_i[idx], dDdx_i[idx], dDdy_i[idx] = nearest
+            sign_i[idx] = np.sign(nearest[0])
+        self._update_cache((x, y, types), [Dist_i, dDdx_i, dDdy_i, sign_i])
         return self._cache_output
 
     def distances(self, x, y, type=None):
@@ -935,173 +959,174 @@ class TurbineSpecificBoundaryComp(MultiPolygonBoundaryComp):
         return Dist_i
 
     def gradients(self, x, y, type=None):
+        """Diagonal of the Jacobian of distances wrt. x and y"""
         Dist_i, dDdx_i, dDdy_i, _ = self.calc_distance_and_gradients(x, y, types=type)
         if self.relaxation:
             Dist_i += self.calc_relaxation()
             dDdt = -self.relaxation[0]
         if self.relaxation:
-            gradients = np.diagflat(dDdx_i), np.diagflat(dDdy_i), np.ones(self.n_wt) * dDdt
+            gradients = dDdx_i, dDdy_i, np.ones(self.n_wt) * dDdt
         else:
-            gradients = np.diagflat(dDdx_i), np.diagflat(dDdy_i)
+            gradients = dDdx_i, dDdy_i
         return gradients
 
 
 def main():
-    if __name__ == '__main__':
-        import matplotlib.pyplot as plt
-        from py_wake.wind_turbines import WindTurbines
-        from py_wake.wind_turbines.power_ct_functions import CubePowerSimpleCt
-
-        plt.close('all')
-        i1 = np.array([[2, 17], [6, 23], [16, 23], [26, 15], [19, 0], [14, 4], [4, 4]])
-        e1 = np.array([[0, 10], [20, 21], [22, 12], [10, 12], [9, 6], [2, 7]])
-        i2 = np.array([[12, 13], [14, 17], [18, 15], [17, 10], [15, 11]])
-        e2 = np.array([[5, 17], [5, 18], [8, 19], [8, 18]])
-        i3 = np.array([[5, 0], [5, 1], [10, 3], [10, 0]])
-        e3 = np.array([[6, -1], [6, 18], [7, 18], [7, -1]])
-        e4 = np.array([[15, 9], [15, 11], [20, 11], [20, 9]])
-        e5 = np.array([[10, 25], [20, 0]])
-        zones = [
-            InclusionZone(i1, name='i1'),
-            InclusionZone(i2, name='i2'),
-            InclusionZone(i3, name='i3'),
-            ExclusionZone(e1, name='e1'),
-            ExclusionZone(e2, name='e2'),
-            ExclusionZone(e3, name='e3'),
-            ExclusionZone(e4, name='e4'),
-            ExclusionZone(e5, name='e5', dist2wt=lambda: 1, geometry_type='line'),
-        ]
-
-        N_points = 50
-        xs = np.linspace(-1, 30, N_points)
-        ys = np.linspace(-1, 30, N_points)
-        y_grid, x_grid = np.meshgrid(xs, ys)
-        x = x_grid.ravel()
-        y = y_grid.ravel()
-        n_wt = len(x)
-        MPBC = MultiPolygonBoundaryComp(n_wt, zones, method='nearest')
-        distances = MPBC.distances(x, y)
-        delta = 1e-9
-        distances2 = MPBC.distances(x + delta, y)
-        dx_fd = (distances2 - distances) / delta
-        dx = np.diag(MPBC.gradients(x + delta / 2, y)[0])
+    import matplotlib.pyplot as plt
+    from py_wake.wind_turbines import WindTurbines
+    from py_wake.wind_turbines.power_ct_functions import CubePowerSimpleCt
+
+    plt.close('all')
+    i1 = np.array([[2, 17], [6, 23], [16, 23], [26, 15], [19, 0], [14, 4], [4, 4]])
+    e1 = np.array([[0, 10], [20, 21], [22, 12], [10, 12], [9, 6], [2, 7]])
+    i2 = np.array([[12, 13], [14, 17], [18, 15], [17, 10], [15, 11]])
+    e2 = np.array([[5, 17], [5, 18], [8, 19], [8, 18]])
+    i3 = np.array([[5, 0], [5, 1], [10, 3], [10, 0]])
+    e3 = np.array([[6, -1], [6, 18], [7, 18], [7, -1]])
+    e4 = np.array([[15, 9], [15, 11], [20, 11], [20, 9]])
+    e5 = np.array([[10, 25], [20, 0]])
+    zones = [
+        InclusionZone(i1, name='i1'),
+        InclusionZone(i2, name='i2'),
+        InclusionZone(i3, name='i3'),
+        ExclusionZone(e1, name='e1'),
+        ExclusionZone(e2, name='e2'),
+        ExclusionZone(e3, name='e3'),
+        ExclusionZone(e4, name='e4'),
+        ExclusionZone(e5, name='e5', dist2wt=lambda: 1, geometry_type='line'),
+    ]
+
+    N_points = 50
+    xs = np.linspace(-1, 30, N_points)
+    ys = np.linspace(-1, 30, N_points)
+    y_grid, x_grid = np.meshgrid(xs, ys)
+    x = x_grid.ravel()
+    y = y_grid.ravel()
+    n_wt = len(x)
+    MPBC = MultiPolygonBoundaryComp(n_wt, zones, method='nearest')
+    distances = MPBC.distances(x, y)
+    delta = 1e-9
+    distances2 = MPBC.distances(x + delta, y)
+    dx_fd = (distances2 - distances) / delta
+    dx = MPBC.gradients(x + delta / 2, y)[0]
+
+    plt.figure()
+    plt.plot(dx_fd, dx, '.')
+
+    plt.figure()
+    for n, bound in enumerate(MPBC.boundaries):
+        x_bound, y_bound = bound[0].T
+        x_bound = np.append(x_bound, x_bound[0])
+        y_bound = np.append(y_bound, y_bound[0])
+        line, = plt.plot(x_bound, y_bound, label=f'{n}')
+        plt.plot(x_bound[0], y_bound[0], color=line.get_color(), marker='o')
+
+    plt.legend()
+    plt.grid()
+    plt.axis('square')
+    plt.contourf(x_grid, y_grid, distances.reshape(N_points, N_points), np.linspace(-10, 10, 100), cmap='seismic')
+    plt.colorbar()
+
+    plt.figure()
+    ax = plt.axes(projection='3d')
+    ax.contour3D(
+        x.reshape(
+            N_points, N_points), y.reshape(
+            N_points, N_points), distances.reshape(
+            N_points, N_points), np.linspace(-10, 10, 100), cmap='seismic')
+    ax.set_xlabel('x')
+    ax.set_ylabel('y')
+    ax.set_zlabel('z')
+
+    if 0:
+        for smpl in [0, 1, 2, 3, 4, 5, 6, 7, 8]:
+            MPBC = MultiPolygonBoundaryComp(n_wt, zones, simplify_geometry=smpl)
+            plt.figure()
+            ax = plt.gca()
+            MPBC.plot(ax)
+
+    wind_turbines = WindTurbines(names=['tb1', 'tb2'],
+                                 diameters=[80, 120],
+                                 hub_heights=[70, 110],
+                                 powerCtFunctions=[
+        CubePowerSimpleCt(ws_cutin=3, ws_cutout=25, ws_rated=12,
+                          power_rated=2000, power_unit='kW',
+                          ct=8 / 9, additional_models=[]),
+        CubePowerSimpleCt(ws_cutin=3, ws_cutout=25, ws_rated=12,
+                          power_rated=3000, power_unit='kW',
+                          ct=8 / 9, additional_models=[])])
+
+    x1 = [0, 3000, 3000, 0]
+    y1 = [0, 0, 3000, 3000]
+    b1 = np.transpose((x1, y1))
+
+    # Buildings
+    x2 = [600, 1400, 1400, 600]
+    y2 = [1700, 1700, 2500, 2500]
+    b2 = np.transpose((x2, y2))
+
+    # River
+    x3 = np.linspace(520, 2420, 16)
+    y3 = [0, 133, 266, 400, 500, 600, 700, 733, 866, 1300, 1633,
+          2100, 2400, 2533, 2700, 3000]
+    b3 = np.transpose((x3, y3))
+
+    # Roads
+    x4 = np.linspace(0, 3000, 16)
+    y4 = [1095, 1038, 1110, 1006, 1028, 992, 977, 1052, 1076, 1064, 1073,
+          1027, 964, 981, 1015, 1058]
+    b4 = np.transpose((x4, y4))
+
+    zones = [
+        InclusionZone(b1, name='i1'),
+        ExclusionZone(b2, dist2wt=lambda H: 4 * H - 360, name='building'),
+        ExclusionZone(b3, geometry_type='line', dist2wt=lambda D: 3 * D, name='river'),
+        ExclusionZone(b4, geometry_type='line', dist2wt=lambda D, H: max(D * 2, H * 3), name='road'),
+    ]
+    N_points = 50
+    xs = np.linspace(0, 3000, N_points)
+    ys = np.linspace(0, 3000, N_points)
+    y_grid, x_grid = np.meshgrid(xs, ys)
+    x = x_grid.ravel()
+    y = y_grid.ravel()
+    n_wt = len(x)
+    types = np.zeros(n_wt)
+    TSBC = TurbineSpecificBoundaryComp(n_wt, wind_turbines, zones)
+    distances = TSBC.distances(x, y, type=types)
+    delta = 1e-9
+    distances2 = TSBC.distances(x + delta, y, type=types)
+    dx_fd = (distances2 - distances) / delta
+    dx = TSBC.gradients(x + delta / 2, y, type=types)[0]
+
+    plt.figure()
+    plt.plot(dx_fd, dx, '.')
+
+    plt.figure()
+    for ll, t in enumerate(TSBC.types):
+        line, = plt.plot(*TSBC.ts_merged_xy_boundaries[ll][0][0][0, :], label=f'type {ll}')
+        for n, bound in enumerate(TSBC.ts_merged_xy_boundaries[ll]):
+            x_bound, y_bound = bound[0].T
+            x_bound = np.append(x_bound, x_bound[0])
+            y_bound = np.append(y_bound, y_bound[0])
+            plt.plot(x_bound, y_bound, color=line.get_color())
 
-        plt.figure()
-        plt.plot(dx_fd, dx, '.')
+    plt.legend()
+    plt.grid()
+    plt.axis('square')
 
+    for ll, t in enumerate(TSBC.types):
         plt.figure()
-        for n, bound in enumerate(MPBC.boundaries):
+        for n, bound in enumerate(TSBC.ts_merged_xy_boundaries[ll]):
             x_bound, y_bound = bound[0].T
             x_bound = np.append(x_bound, x_bound[0])
             y_bound = np.append(y_bound, y_bound[0])
-            line, = plt.plot(x_bound, y_bound, label=f'{n}')
-            plt.plot(x_bound[0], y_bound[0], color=line.get_color(), marker='o')
-
-        plt.legend()
+            plt.plot(x_bound, y_bound, 'b')
         plt.grid()
+        plt.title(f'type {ll}')
         plt.axis('square')
-        plt.contourf(x_grid, y_grid, distances.reshape(N_points, N_points), np.linspace(-10, 10, 100), cmap='seismic')
+        plt.contourf(x_grid, y_grid, TSBC.distances(x, y, type=t * np.ones(n_wt)).reshape(N_points, N_points), 50)
         plt.colorbar()
 
-        plt.figure()
-        ax = plt.axes(projection='3d')
-        ax.contour3D(
-            x.reshape(
-                N_points, N_points), y.reshape(
-                N_points, N_points), distances.reshape(
-                N_points, N_points), np.linspace(-10, 10, 100), cmap='seismic')
-        ax.set_xlabel('x')
-        ax.set_ylabel('y')
-        ax.set_zlabel('z')
-
-        if 0:
-            for smpl in [0, 1, 2, 3, 4, 5, 6, 7, 8]:
-                MPBC = MultiPolygonBoundaryComp(n_wt, zones, simplify_geometry=smpl)
-                plt.figure()
-                ax = plt.gca()
-                MPBC.plot(ax)
-
-        wind_turbines = WindTurbines(names=['tb1', 'tb2'],
-                                     diameters=[80, 120],
-                                     hub_heights=[70, 110],
-                                     powerCtFunctions=[
-            CubePowerSimpleCt(ws_cutin=3, ws_cutout=25, ws_rated=12,
-                              power_rated=2000, power_unit='kW',
-                              ct=8 / 9, additional_models=[]),
-            CubePowerSimpleCt(ws_cutin=3, ws_cutout=25, ws_rated=12,
-                              power_rated=3000, power_unit='kW',
-                              ct=8 / 9, additional_models=[])])
-
-        x1 = [0, 3000, 3000, 0]
-        y1 = [0, 0, 3000, 3000]
-        b1 = np.transpose((x1, y1))
-
-        # Buildings
-        x2 = [600, 1400, 1400, 600]
-        y2 = [1700, 1700, 2500, 2500]
-        b2 = np.transpose((x2, y2))
-
-        # River
-        x3 = np.linspace(520, 2420, 16)
-        y3 = [0, 133, 266, 400, 500, 600, 700, 733, 866, 1300, 1633,
-              2100, 2400, 2533, 2700, 3000]
-        b3 = np.transpose((x3, y3))
-
-        # Roads
-        x4 = np.linspace(0, 3000, 16)
-        y4 = [1095, 1038, 1110, 1006, 1028, 992, 977, 1052, 1076, 1064, 1073,
-              1027, 964, 981, 1015, 1058]
-        b4 = np.transpose((x4, y4))
-
-        zones = [
-            InclusionZone(b1, name='i1'),
-            ExclusionZone(b2, dist2wt=lambda H: 4 * H - 360, name='building'),
-            ExclusionZone(b3, geometry_type='line', dist2wt=lambda D: 3 * D, name='river'),
-            ExclusionZone(b4, geometry_type='line', dist2wt=lambda D, H: max(D * 2, H * 3), name='road'),
-        ]
-        N_points = 50
-        xs = np.linspace(0, 3000, N_points)
-        ys = np.linspace(0, 3000, N_points)
-        y_grid, x_grid = np.meshgrid(xs, ys)
-        x = x_grid.ravel()
-        y = y_grid.ravel()
-        n_wt = len(x)
-        types = np.zeros(n_wt)
-        TSBC = TurbineSpecificBoundaryComp(n_wt, wind_turbines, zones)
-        distances = TSBC.distances(x, y, type=types)
-        delta = 1e-9
-        distances2 = TSBC.distances(x + delta, y, type=types)
-        dx_fd = (distances2 - distances) / delta
-        dx = np.diag(TSBC.gradients(x + delta / 2, y, type=types)[0])
-
-        plt.figure()
-        plt.plot(dx_fd, dx, '.')
-
-        plt.figure()
-        for ll, t in enumerate(TSBC.types):
-            line, = plt.plot(*TSBC.ts_merged_xy_boundaries[ll][0][0][0, :], label=f'type {ll}')
-            for n, bound in enumerate(TSBC.ts_merged_xy_boundaries[ll]):
-                x_bound, y_bound = bound[0].T
-                x_bound = np.append(x_bound, x_bound[0])
-                y_bound = np.append(y_bound, y_bound[0])
-                plt.plot(x_bound, y_bound, color=line.get_color())
-
-        plt.legend()
-        plt.grid()
-        plt.axis('square')
 
-        for ll, t in enumerate(TSBC.types):
-            plt.figure()
-            for n, bound in enumerate(TSBC.ts_merged_xy_boundaries[ll]):
-                x_bound, y_bound = bound[0].T
-                x_bound = np.append(x_bound, x_bound[0])
-                y_bound = np.append(y_bound, y_bound[0])
-                plt.plot(x_bound, y_bound, 'b')
-            plt.grid()
-            plt.title(f'type {ll}')
-            plt.axis('square')
-            plt.contourf(x_grid, y_grid, TSBC.distances(x, y, type=t * np.ones(n_wt)).reshape(N_points, N_points), 50)
-            plt.colorbar()
-
-
-main()
+if __name__ == '__main__':
+    main()
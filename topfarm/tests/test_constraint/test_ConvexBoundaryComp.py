@@ -99,3 +99,33 @@ def test_move_inside():
     npt.assert_array_less(y, 10 + eps)
     npt.assert_array_less(-x, 0 + eps)
     npt.assert_array_less(-y, 0 + eps)
+
+
+def test_move_inside_far_outside():
+    for boundary in [[(0, 0), (10, 0), (10, 10), (0, 10)], [(0, 0), (1000, 0), (500, 1)]]:
+        pbc = ConvexBoundaryComp(3, boundary)
+        state = pbc.satisfy({'x': [200, 5, 1012], 'y': [5, .5, 1012]})
+        npt.assert_array_less(-1e-10, pbc.distances(state['x'], state['y']))
+    pbc = ConvexBoundaryComp(1, [(0, 0), (10, 0), (10, 10), (0, 10)])
+    state = pbc.satisfy({'x': [200], 'y': [5]})
+    # moved to just inside the nearest face
+    npt.assert_array_almost_equal([state['x'][0], state['y'][0]], [10, 5], 1)
+
+
+def test_move_inside_many_vertices():
+    # the work in satisfy is linear in the number of vertices
+    t = np.linspace(0, 2 * np.pi, 1000, endpoint=False)
+    pbc = ConvexBoundaryComp(4, np.array([np.cos(t), np.sin(t)]).T * 1000)
+    state = pbc.satisfy({'x': [5000, 0, -1200, 10], 'y': [0, 3000, 0, 10]})
+    dist = pbc.distances(state['x'], state['y']).min(1)
+    npt.assert_array_less(0, dist)
+    npt.assert_array_less(dist[:3], 10 + 1e-6)  # just inside
+    npt.assert_array_equal([state['x'][3], state['y'][3]], [10, 10])
+
+
+def test_move_inside_vanishing_face():
+    # the short face at the tip vanishes when the faces are shifted by the margin
+    pbc = ConvexBoundaryComp(1, [(0, -1000), (1000, -.1), (1000, .1), (0, 1000)])
+    state = pbc.satisfy({'x': [2000], 'y': [0]})
+    npt.assert_array_less(0, pbc.distances(state['x'], state['y']))
+    npt.assert_array_almost_equal([state['x'][0], state['y'][0]], [1000, 0], 0)
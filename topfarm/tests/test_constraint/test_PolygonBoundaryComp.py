@@ -90,3 +90,37 @@ def test_satisfy():
     state = pbc.satisfy({'x': [3, 3, 3], 'y': [0, 5, 10]})
     x, y = state['x'], state['y']
     npt.assert_array_less(y, x)
+
+
+def test_calc_distance_many_edges():
+    t = np.linspace(0, 2 * np.pi, 41)[:-1]
+    boundary = np.array([np.cos(t), np.sin(t)]).T * 10
+    points = np.array([(0, 1), (0, 5), (0, 11)])
+    c = np.cos(np.pi / 40)  # (0, 10) is a vertex and the adjacent edges are tilted pi/40
+    check(boundary, points, [9 * c, 5 * c, -1])
+
+
+def test_edge_blocks():
+    t = np.linspace(0, 2 * np.pi, 41)[:-1]
+    pbc = PolygonBoundaryComp(1, np.array([np.cos(t), np.sin(t)]).T * (10 + np.sin(7 * t))[:, np.newaxis])
+    x, y = np.random.RandomState(0).uniform(-12, 12, (2, 100))
+    ref = pbc._calc_nearest_distance_and_gradients(x, y)
+    pbc.edge_block_size = 3
+    npt.assert_array_equal(pbc._calc_nearest_distance_and_gradients(x, y), ref)
+
+
+def test_cache_inplace_update():
+    pbc = PolygonBoundaryComp(1, [(0, 0), (2, 0), (2, 2), (0, 2)])
+    x, y = np.array([1.]), np.array([1.])
+    npt.assert_array_almost_equal(pbc.distances(x, y), [1])
+    x[:] = .5  # OpenMDAO updates inputs in place
+    npt.assert_array_almost_equal(pbc.distances(x, y), [.5])
+    npt.assert_array_almost_equal(pbc.distances(np.array([.5, 1]), np.array([1, 1])), [.5, 1])
+
+
+def test_gradients_at_vertices():
+    # points on a vertex must not be classified as closer to the end point of the previous edge
+    pbc = PolygonBoundaryComp(3, [(.1, .3), (7.7, .2), (3.3, 9.1)])
+    x, y = np.array([(.1, .3), (7.7, .2), (3.3, 9.1)]).T
+    npt.assert_array_equal(pbc.distances(x, y), 0)
+    assert np.all(np.isfinite(pbc.gradients(x, y)))
@@ -1,4 +1,5 @@
 import numpy as np
+import openmdao.api as om
 from topfarm.cost_models.dummy import DummyCost, DummyCostPlotComp
 
 from topfarm.plotting import NoPlot, XYPlotComp
@@ -172,3 +173,37 @@ def testChangingNumberOfTurbines():
     _, _, sign2 = MPBC.calc_distance_and_gradients(X2, Y2)
     sign_ref2 = np.array([0, 0])
     np.testing.assert_allclose(sign2, sign_ref2)
+
+
+def testMultiPolygonSatisfy():
+    zones = [InclusionZone([(0, 0), (4, 0), (4, 4), (0, 4)])]
+    MPBC = MultiPolygonBoundaryComp(3, zones)
+    state = MPBC.satisfy({'x': [5., 1, 2], 'y': [1., 1, 2]})
+    np.testing.assert_allclose(state['x'], [3.9, 1, 2])
+    np.testing.assert_allclose(state['y'], [1, 1, 2])
+
+
+def testMultiPolygonCacheInplaceUpdate():
+    zones = [InclusionZone([(0, 0), (4, 0), (4, 4), (0, 4)]),
+             ExclusionZone([(1, 1), (2, 1), (2, 2), (1, 2)])]
+    MPBC = MultiPolygonBoundaryComp(1, zones)
+    x, y = np.array([3.]), np.array([1.5])
+    np.testing.assert_allclose(MPBC.distances(x, y), [1])
+    x[:] = 2.5  # OpenMDAO updates inputs in place
+    np.testing.assert_allclose(MPBC.distances(x, y), [.5])
+
+
+def testMultiPolygonPartials():
+    zones = [InclusionZone([(0, 0), (4, 0), (4, 4), (0, 4)]),
+             ExclusionZone([(1, 1), (2, 1), (2, 2), (1, 2)])]
+    for method, diagonal in [('nearest', True), ('smooth_min', False)]:
+        MPBC = MultiPolygonBoundaryComp(3, zones, method=method)
+        assert MPBC.diagonal_partials == diagonal
+        prob = om.Problem()
+        prob.model.add_subsystem('boundary', MPBC, promotes=['*'])
+        prob.setup()
+        prob.set_val('x', [3., .5, 2.5])
+        prob.set_val('y', [1.5, 3., 3.5])
+        prob.run_model()
+        # raises if the computed partials have nonzeros outside the declared sparsity
+        prob.check_partials(out_stream=None)
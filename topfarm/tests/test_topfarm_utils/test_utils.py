@@ -2,7 +2,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pytest
 
-from topfarm.utils import smart_start, SmoothMax, SmoothMin, SoftMax, StrictMax, StrictMin, LogSumExpMax, LogSumExpMin
+from topfarm.utils import smart_start, SmoothMax, SmoothMin, SoftMax, StrictMax, StrictMin, LogSumExpMax, LogSumExpMin, \
+    smooth_max_and_gradient
 from topfarm.tests import npt
 from topfarm import TopFarmProblem
 from topfarm.easy_drivers import EasyScipyOptimizeDriver
@@ -273,3 +274,15 @@ def test_max_funcs(max_func, scaling, ref):
     else:
         mask = slice(None)
     npt.assert_array_almost_equal(dmax_da_fd(x)[mask], dm_da[mask], 4)
+
+
+@pytest.mark.parametrize('alpha', [-2, .5])
+def test_smooth_max_and_gradient(alpha):
+    X = np.array([[0., 1., 3.], [2., 2.5, .5]])
+    S, dSdX = smooth_max_and_gradient(X, alpha, axis=1)
+    w = np.exp(alpha * X) / np.exp(alpha * X).sum(1)[:, None]
+    npt.assert_array_almost_equal(S, (X * w).sum(1))
+    step = 1e-6
+    dSdX_fd = [(smooth_max_and_gradient(X + step * (np.arange(3) == j), alpha, axis=1)[0] - S) / step
+               for j in range(3)]
+    npt.assert_array_almost_equal(dSdX, np.array(dSdX_fd).T, 5)
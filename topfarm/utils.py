@@ -203,8 +203,34 @@ def smooth_max_gradient(X, alpha, axis=0):
         Matrix of smooth maximum derivatives.
 
     '''
-    return np.exp(alpha * X) / np.expand_dims(np.exp(alpha * X).sum(axis=axis), axis) * \
-        (1 + alpha * (X - np.expand_dims(smooth_max(X, alpha, axis=axis), axis)))
+    return smooth_max_and_gradient(X, alpha, axis)[1]
+
+
+def smooth_max_and_gradient(X, alpha, axis=0):
+    '''
+    Returns the smooth maximum (see smooth_max) and its derivative (see smooth_max_gradient) from one
+    evaluation of the exponentials. The exponents are shifted by their maximum to avoid overflow and underflow
+    Parameters
+    ----------
+    X : ndarray
+        Matrix of which the smooth maximum and its derivative is calculated.
+    alpha : float
+        smoothness parameter.
+    axis : int, optional
+        Axis along which the smooth maximum is calculated. The default is 0.
+
+    Returns
+    -------
+    tuple of ndarray
+        Matrix of smooth maximum values and matrix of smooth maximum derivatives.
+
+    '''
+    X = np.asarray(X)
+    alpha_X = alpha * X
+    exp_alpha_X = np.exp(alpha_X - alpha_X.max(axis=axis, keepdims=True))
+    weights = exp_alpha_X / exp_alpha_X.sum(axis=axis, keepdims=True)
+    S = (X * weights).sum(axis=axis, keepdims=True)
+    return S.squeeze(axis), weights * (1 + alpha * (X - S))
 
 
 def gauss(X):